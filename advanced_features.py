@@ -5,11 +5,23 @@ These features can be implemented by importing and using these components in app
 
 from langchain.chains import SequentialChain
 from langchain.chains.base import Chain
-from langchain.prompts import PromptTemplate
-from langchain.memory import ConversationBufferMemory
+from langchain.prompts import ChatPromptTemplate, PromptTemplate
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain.memory import ConversationSummaryBufferMemory
 from langchain.output_parsers import StructuredOutputParser, ResponseSchema
-from typing import Dict, List, Any
+import asyncio
+import importlib
+import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, Dict, List, Any, Optional, Tuple, Union
 from langchain.chains import LLMChain
+from email_cache import get_completion, hash_api_key, make_cache_key, store_completion
+from llm_utils import add_cache_control, extract_cache_usage, is_truncated, run_async
+
+logger = logging.getLogger(__name__)
 
 # 1. Structured Output Parser for Email Components
 def create_output_parser():
@@ -34,7 +46,64 @@ def create_output_parser():
     return StructuredOutputParser.from_response_schemas(response_schemas)
 
 # 2. Advanced Email Chain with Analysis Step
-def create_advanced_email_chain(llm) -> Chain:
+def create_advanced_email_chain(llm, verbose: bool = False) -> Chain:
+    """Creates a chain that analyzes the subject and writes the email in one LLM call (two with verbose=True)"""
+    
+    if verbose:
+        return _create_two_step_email_chain(llm)
+    
+    single_call_template = """
+    You are an AI Email Marketing Expert with years of experience crafting engaging, professional emails.
+    
+    Step 1 (internal, do not output): Analyze the subject below to determine:
+    1. The primary purpose (promotional, informational, invitation, etc.)
+    2. The appropriate tone (formal, conversational, urgent, etc.)
+    3. The target audience characteristics
+    4. Key points that should be emphasized
+    
+    Step 2: Based on your analysis, create a comprehensive email that includes:
+    1. An attention-grabbing subject line that builds on the provided subject
+    2. A personalized greeting with [Name] placeholder
+    3. A concise but compelling body (2-3 paragraphs)
+    4. A clear call-to-action
+    5. A professional sign-off
+    
+    The email should follow this structure:
+    ---
+    Subject: [Enhanced Subject Line]
+    
+    Dear [Name],
+    
+    [First paragraph: Introduction and hook related to the subject]
+    
+    [Second paragraph: Key details and value proposition]
+    
+    [Third paragraph (optional): Additional information or urgency element]
+    
+    [Clear call-to-action with specific instructions]
+    
+    [Professional sign-off],
+    [Company Name]
+    ---
+    
+    Keep the email concise, engaging, and focused on driving action. Use persuasive language throughout.
+    Only output the email.
+    
+    SUBJECT: {subject}
+    """
+    
+    single_call_prompt = PromptTemplate(
+        input_variables=["subject"],
+        template=single_call_template
+    )
+    
+    return LLMChain(
+        llm=llm,
+        prompt=single_call_prompt,
+        output_key="email"
+    )
+
+def _create_two_step_email_chain(llm) -> Chain:
     """Creates a two-step chain that first analyzes the subject, then generates the email"""
     
     # Step 1: Analyze the subject
@@ -120,10 +189,35 @@ def create_advanced_email_chain(llm) -> Chain:
     return sequential_chain
 
 # 3. Email Chain with Memory for Follow-up Emails
-def create_email_chain_with_memory(llm) -> Chain:
-    """Creates an email chain that maintains conversation history for follow-up emails"""
+memento_template = """
+Compress the following email into a 1-2 line memento capturing only its subject, call-to-action and tone.
+
+EMAIL:
+{email}
+
+Memento:
+"""
+
+MEMENTO_PROMPT = PromptTemplate(
+    input_variables=["email"],
+    template=memento_template
+)
+
+class MementoMemory(ConversationSummaryBufferMemory):
+    """Summary buffer memory that stores a short memento of each email instead of its full text"""
+    
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        output_key = self.output_key or next(iter(outputs))
+        memento = self.llm.invoke(MEMENTO_PROMPT.format(email=outputs[output_key]))
+        memento = getattr(memento, "content", memento)
+        super().save_context(inputs, {output_key: memento.strip()})
+
+def create_email_chain_with_memory(llm, max_token_limit: int = 400) -> Chain:
+    """Creates an email chain that maintains a compact history for follow-up emails"""
     
-    memory = ConversationBufferMemory(
+    memory = MementoMemory(
+        llm=llm,
+        max_token_limit=max_token_limit,
         memory_key="chat_history",
         input_key="subject"
     )
@@ -178,14 +272,14 @@ def create_email_chain_with_memory(llm) -> Chain:
     return follow_up_chain
 
 # 4. Email Template Customization Function
-def create_custom_email_template(tone: str, length: int, include_ps: bool) -> PromptTemplate:
-    """Creates a customized email template based on user parameters"""
+@lru_cache(maxsize=64)
+def create_custom_email_template(tone: str, length: int, include_ps: bool) -> ChatPromptTemplate:
+    """Creates a customized email template based on user parameters; the result is shared, so do not mutate it"""
     
     # Base template
-    template = """
+    parts = ["""
     You are an AI Email Marketing Expert with years of experience crafting engaging, professional emails.
     
-    SUBJECT: {subject}
     REQUESTED TONE: {tone}
     EMAIL LENGTH: {length} paragraphs
     
@@ -195,33 +289,33 @@ def create_custom_email_template(tone: str, length: int, include_ps: bool) -> Pr
     3. A body with exactly {length} paragraphs
     4. A clear call-to-action
     5. A professional sign-off
-    """
+    """]
     
     # Add PS instruction if requested
     if include_ps:
-        template += """
+        parts.append("""
     6. A brief PS line that adds value or creates urgency
-    """
+    """)
     
     # Add tone-specific instructions
     if tone == "formal":
-        template += """
+        parts.append("""
     Use formal language, avoid contractions, and maintain professional distance.
     Address the recipient with proper titles and use industry-specific terminology where appropriate.
-    """
+    """)
     elif tone == "friendly":
-        template += """
+        parts.append("""
     Use a warm, conversational tone with a personal touch.
     Include light humor where appropriate and focus on building relationship.
-    """
+    """)
     elif tone == "urgent":
-        template += """
+        parts.append("""
     Create a sense of urgency throughout the email.
     Use time-sensitive language and emphasize limited availability or deadlines.
-    """
+    """)
     
     # Add email structure
-    template += """
+    parts.append("""
     The email should follow this structure:
     ---
     Subject: [Enhanced Subject Line]
@@ -234,87 +328,172 @@ def create_custom_email_template(tone: str, length: int, include_ps: bool) -> Pr
     
     [Professional sign-off],
     [Company Name]
-    """
+    """)
     
     # Add PS if requested
     if include_ps:
-        template += """
+        parts.append("""
     
     P.S. [Brief value-add or urgency statement]
-    """
+    """)
     
-    template += """
+    parts.append("""
     ---
     
     Keep the email concise, engaging, and focused on driving action. Use persuasive language throughout.
-    """
+    """)
     
-    return PromptTemplate(
-        input_variables=["subject", "tone", "length"],
-        template=template
+    # Bake the settings into the instructions so each call only formats the subject
+    system_template = (
+        "".join(parts)
+        .replace("{tone}", _escape_braces(tone))
+        .replace("{length}", str(length))
     )
+    
+    return ChatPromptTemplate.from_messages([
+        ("system", system_template),
+        ("human", "SUBJECT: {subject}")
+    ])
+
+def _escape_braces(text: str) -> str:
+    """Escapes literal braces so text can be embedded in a prompt template"""
+    return text.replace("{", "{{").replace("}", "}}")
 
 # 5. Multi-Provider Support
-def get_llm_by_provider(provider: str, api_key: str):
-    """Returns appropriate LLM based on the provider"""
-    if provider == "openai":
-        from langchain_openai import OpenAI
-        return OpenAI(
-            temperature=0.7,
-            max_tokens=1024,
-            model_name="gpt-3.5-turbo-instruct",
-            openai_api_key=api_key
-        )
-    elif provider == "openai-chat":
-        from langchain_openai import ChatOpenAI
-        return ChatOpenAI(
+# LLM clients keyed by (provider, API key hash) so each client's HTTP connection pool is reused
+MAX_CACHED_LLMS = 8
+_llm_clients: "OrderedDict[Tuple[str, str], Any]" = OrderedDict()
+_llm_clients_lock = threading.Lock()
+
+@lru_cache(maxsize=None)
+def _load_llm_class(module: str, name: str):
+    """Imports a provider's LLM class on first use"""
+    try:
+        return getattr(importlib.import_module(module), name)
+    except ImportError as e:
+        raise ImportError(f"Install {module.replace('_', '-')} to use this provider") from e
+
+def _create_llm(provider: str, api_key: str):
+    """Builds a new LLM client for the provider"""
+    if provider == "openai-chat":
+        return _load_llm_class("langchain_openai", "ChatOpenAI")(
             temperature=0.7,
             model_name="gpt-3.5-turbo",
             openai_api_key=api_key
         )
     elif provider == "anthropic":
-        from langchain_anthropic import ChatAnthropic
-        return ChatAnthropic(
+        return _load_llm_class("langchain_anthropic", "ChatAnthropic")(
             temperature=0.7,
             max_tokens=1024,
-            model="claude-2",
+            model="claude-3-haiku-20240307",
             anthropic_api_key=api_key
         )
     else:
         # Default to OpenAI
-        from langchain_openai import OpenAI
-        return OpenAI(
+        return _load_llm_class("langchain_openai", "OpenAI")(
             temperature=0.7,
             max_tokens=1024,
             model_name="gpt-3.5-turbo-instruct",
             openai_api_key=api_key
         )
 
+def get_llm_by_provider(provider: str, api_key: str):
+    """Returns appropriate LLM based on the provider, reusing clients across calls"""
+    key = (provider, hash_api_key(api_key))
+    with _llm_clients_lock:
+        llm = _llm_clients.get(key)
+        if llm is not None:
+            _llm_clients.move_to_end(key)
+            return llm
+        
+        llm = _create_llm(provider, api_key)
+        _llm_clients[key] = llm
+        if len(_llm_clients) > MAX_CACHED_LLMS:
+            _llm_clients.popitem(last=False)
+        return llm
+
 # 6. Function to integrate settings from the UI
 def generate_email_with_settings(subject: str, api_key: str, model_type: str = "openai", 
-                               tone: str = "Professional", length: int = 3, include_ps: bool = False) -> str:
-    """Generates an email with custom settings"""
+                               tone: str = "Professional", length: int = 3, include_ps: bool = False,
+                               on_usage: Optional[Callable[[Dict[str, int]], None]] = None) -> str:
+    """Generates an email with custom settings, passing prompt cache token counts to on_usage"""
     
     # Get the appropriate LLM
     llm = get_llm_by_provider(model_type, api_key)
+    prompt = _build_email_prompt(llm, subject, model_type, tone, length, include_ps)
+    
+    # Generate email, reusing the stored result for identical requests.
+    # The cache fails open: any cache error is logged and treated as a miss.
+    key = make_cache_key(subject, model_type, tone, length, include_ps, hash_api_key(api_key))
+    try:
+        result = get_completion(key)
+    except Exception:
+        logger.warning("Cache lookup failed", exc_info=True)
+        result = None
+    if result is None:
+        if isinstance(llm, BaseChatModel):
+            response = llm.invoke(prompt)
+            usage, result = extract_cache_usage(response), response.content
+        else:
+            # Completion models return a plain string from invoke, so generate is used to get the finish reason
+            llm_result = llm.generate([prompt])
+            response = llm_result.generations[0][0]
+            usage, result = extract_cache_usage(llm_result.llm_output or {}), response.text
+        if on_usage is not None:
+            on_usage(usage)
+        # An email cut off by the token limit is returned but not stored
+        if not is_truncated(response):
+            try:
+                store_completion(key, result)
+            except Exception:
+                logger.warning("Storing in the cache failed", exc_info=True)
     
-    # Create custom template
+    return result.strip()
+
+def _build_email_prompt(llm, subject: str, model_type: str, tone: str, length: int,
+                        include_ps: bool) -> Union[str, List[BaseMessage]]:
+    """Formats the custom template as chat messages, or as a plain prompt for completion models"""
     prompt_template = create_custom_email_template(
         tone.lower(), 
         length, 
         include_ps
     )
+    messages = prompt_template.format_messages(subject=subject)
+    if not isinstance(llm, BaseChatModel):
+        # Joined without role labels, so completion models do not see a System/Human transcript
+        return "\n".join(message.content for message in messages)
+    # Mark the static prefix as cacheable where the provider needs it
+    if model_type == "anthropic":
+        messages = add_cache_control(messages)
+    return messages
+
+# 7. Multiple Email Variants
+# Providers whose API can return several completions for one prompt via the n parameter
+N_COMPLETIONS_PROVIDERS = {"openai-chat"}
+
+def generate_email_variants_with_settings(subject: str, api_key: str, model_type: str = "openai-chat",
+                                          n: int = 3, tone: str = "Professional", length: int = 3,
+                                          include_ps: bool = False,
+                                          on_usage: Optional[Callable[[Dict[str, int]], None]] = None) -> List[str]:
+    """Generates n alternative emails with custom settings"""
     
-    # Create chain
-    chain = LLMChain(
-        llm=llm,
-        prompt=prompt_template
-    )
-    
-    # Generate email
-    result = chain.run(subject=subject, tone=tone.lower(), length=length)
-    
-    return result.strip()
+    llm = get_llm_by_provider(model_type, api_key)
+    prompt = _build_email_prompt(llm, subject, model_type, tone, length, include_ps)
+    
+    if model_type in N_COMPLETIONS_PROVIDERS:
+        result = llm.generate([prompt], n=n)
+        if on_usage is not None:
+            on_usage(extract_cache_usage(result.llm_output or {}))
+        return [generation.text.strip() for generation in result.generations[0]]
+    
+    async def _gather() -> List[Any]:
+        return await asyncio.gather(*[llm.ainvoke(prompt) for _ in range(n)])
+    
+    responses = run_async(_gather())
+    if on_usage is not None:
+        for response in responses:
+            on_usage(extract_cache_usage(response))
+    return [getattr(response, "content", response).strip() for response in responses]
 
 # Import these in the main app to use them
 # from advanced_features import generate_email_with_settings, create_advanced_email_chain
\ No newline at end of file
@@ -1,14 +1,23 @@
 import streamlit as st
-from langchain.prompts import PromptTemplate
-from langchain_openai import OpenAI
-from langchain.chains import LLMChain
-from langchain_groq import ChatGroq
+from langchain.prompts import ChatPromptTemplate
+import asyncio
+import logging
 import os
 from dotenv import load_dotenv
 
+try:
+    import tiktoken
+except ImportError:  # Prompt size checks are skipped without tiktoken
+    tiktoken = None
+from email_cache import clear_cache, get_completion, hash_api_key, make_cache_key, store_completion
+from semantic_cache import get_semantic_cache
+from llm_utils import is_truncated, run_async
+
 # Load environment variables from .env file
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Set page configuration
 st.set_page_config(
     page_title="Smart Email Generator",
@@ -34,29 +43,61 @@ if not api_key:
         st.stop()
 
 # Initialize LangChain LLM (cached for efficiency)
+MAX_OUTPUT_TOKENS = 1024
+
+# Output token budget sized to the requested email rather than a fixed ceiling,
+# which bounds worst-case latency and lets the provider schedule requests tighter
+def email_max_tokens(length, include_ps):
+    return min(120 + length * 100 + (80 if include_ps else 0), MAX_OUTPUT_TOKENS)
+
+# The provider import happens here rather than at the top of the script, so it is
+# only paid when a model is first loaded. The raw key is kept out of the cache hash;
+# its digest is hashed instead, so each key gets its own client.
 @st.cache_resource
-def load_llm(_api_key):
+def load_llm(_api_key, api_key_hash, model_name="llama3-8b-8192", max_tokens=MAX_OUTPUT_TOKENS):
+    from langchain_groq import ChatGroq
     return ChatGroq(
         temperature=0.7,
-        max_tokens=1024,
-        model_name="llama3-8b-8192",  # or any other Groq model you prefer
-        groq_api_key=_api_key
+        max_tokens=max_tokens,
+        model_name=model_name,
+        groq_api_key=_api_key,
+        streaming=True
     )
 
-# Email generation prompt template using LangChain
-email_template = """
-You are an AI Email Marketing Expert with years of experience crafting engaging, professional emails. Your task is to generate a complete email based on the subject line provided.
+# Models used when the provider is set to "Auto"
+FAST_MODEL = "llama3-8b-8192"
+LARGE_MODEL = "llama2-70b-4096"
 
-SUBJECT: {subject}
+# Context window of each model, used to reject prompts that cannot fit
+MODEL_CONTEXT_TOKENS = {
+    "llama3-8b-8192": 8192,
+    "llama2-70b-4096": 4096
+}
+
+# Route simple subjects to the faster, cheaper model and reserve the large model for complex ones
+def route_model(subject: str) -> str:
+    score = (
+        (len(subject) > 80)
+        + ('?' in subject)
+        + (sum(c.isdigit() for c in subject) > 2)
+        + (len(subject.split()) > 12)
+    )
+    return LARGE_MODEL if score >= 2 else FAST_MODEL
+
+# Email generation prompt using LangChain.
+# Static instructions come first and the per-request values last, so providers
+# can reuse the cached prompt prefix across calls.
+email_system_template = """
+You are an AI Email Marketing Expert with years of experience crafting engaging, professional emails. Your task is to generate a complete email based on the subject line provided.
 
 Please create a comprehensive email that includes:
 1. An attention-grabbing subject line that builds on the provided subject
 2. A personalized greeting with [Name] placeholder
-3. A concise but compelling body (2-3 paragraphs)
+3. A concise but compelling body with the requested number of paragraphs
 4. A clear call-to-action
 5. A professional sign-off
 
-Adjust the tone and style to match the context of the subject (formal, urgent, friendly, promotional, etc.).
+Write in the requested tone, adjusting the style to match the context of the subject (formal, urgent, friendly, promotional, etc.).
 
 The email should follow this structure:
 ---
@@ -79,27 +120,147 @@ Dear [Name],
 Keep the email concise, engaging, and focused on driving action. Use persuasive language throughout.
 """
 
-# Function to generate email using LangChain
-def generate_email(subject, api_key, model_type="openai"):
-    if model_type == "openai":
-        llm = load_llm(api_key)
-    else:
-        # Support for additional models can be added here
-        llm = load_llm(api_key)
+email_user_template = """SUBJECT: {subject}
+TONE: {tone}
+EMAIL LENGTH: {length} paragraphs
+{ps_instruction}"""
+
+PS_INSTRUCTION = "Add a brief PS line after the sign-off that adds value or creates urgency."
+
+# Create LangChain prompt template once per process; Streamlit re-executes this
+# script on every interaction, so a plain module-level constant would be rebuilt each time
+@st.cache_resource
+def get_email_prompt():
+    return ChatPromptTemplate.from_messages([
+        ("system", email_system_template),
+        ("human", email_user_template)
+    ])
+
+# Prompt-plus-LLM chain, built once per API key and model
+@st.cache_resource
+def get_chain(_api_key, api_key_hash, model_name, max_tokens=MAX_OUTPUT_TOKENS):
+    return get_email_prompt() | load_llm(_api_key, api_key_hash, model_name, max_tokens)
+
+# Values for the per-request part of the prompt
+def email_prompt_inputs(subject, tone, length, include_ps):
+    return {
+        "subject": subject,
+        "tone": tone.lower(),
+        "length": length,
+        "ps_instruction": PS_INSTRUCTION if include_ps else ""
+    }
+
+# Tokenizer and the token ids of the static system prompt, encoded once per process.
+# Groq accepts text only, so the ids are used to size-check prompts before sending them;
+# only the short per-request part is tokenized on each call.
+# tiktoken downloads its encoding on first use; if that fails the check is skipped.
+@st.cache_resource
+def get_static_prompt_ids():
+    if tiktoken is None:
+        return None, None
+    try:
+        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    except Exception:
+        logger.warning("Could not load the tiktoken encoding; prompt size checks are disabled", exc_info=True)
+        return None, None
+    return encoding, encoding.encode(email_system_template)
+
+# Approximate prompt size in tokens, or None when tiktoken is not installed
+def count_prompt_tokens(subject, tone, length, include_ps):
+    encoding, static_ids = get_static_prompt_ids()
+    if encoding is None:
+        return None
+    user_message = email_user_template.format(**email_prompt_inputs(subject, tone, length, include_ps))
+    return len(static_ids) + len(encoding.encode(user_message))
+
+# Fail fast instead of sending a prompt that leaves no room for the email
+def check_prompt_size(subject, model_name, tone, length, include_ps):
+    prompt_tokens = count_prompt_tokens(subject, tone, length, include_ps)
+    context_tokens = MODEL_CONTEXT_TOKENS.get(model_name)
+    if prompt_tokens is not None and context_tokens is not None:
+        max_tokens = email_max_tokens(length, include_ps)
+        if prompt_tokens + max_tokens > context_tokens:
+            raise ValueError(
+                f"The subject is too long for {model_name}: the prompt needs about "
+                f"{prompt_tokens} of {context_tokens - max_tokens} available tokens."
+            )
+
+# Function to generate email using LangChain, streamed token by token
+def stream_email(subject, api_key, model_name, tone="Professional", length=3, include_ps=False):
+    check_prompt_size(subject, model_name, tone, length, include_ps)
+    chain = get_chain(api_key, hash_api_key(api_key), model_name, email_max_tokens(length, include_ps))
     
-    # Create LangChain prompt template
-    prompt = PromptTemplate(
-        input_variables=["subject"],
-        template=email_template
-    )
+    message = None
+    for chunk in chain.stream(email_prompt_inputs(subject, tone, length, include_ps)):
+        message = chunk if message is None else message + chunk
+        yield chunk.content
     
-    # Create LangChain
-    chain = LLMChain(llm=llm, prompt=prompt)
+    record_truncation([message])
+
+# Async variant so several emails can be generated concurrently
+async def agenerate_email(subject, chain, tone="Professional", length=3, include_ps=False):
+    return await chain.ainvoke(email_prompt_inputs(subject, tone, length, include_ps))
+
+# Generate one email per subject with all LLM calls in flight at once.
+# Without a model name, each subject is routed to a model by its complexity.
+def generate_emails_concurrently(subjects, api_key, model_name=None, tone="Professional", length=3, include_ps=False):
+    models = [model_name or route_model(s) for s in subjects]
+    max_tokens = email_max_tokens(length, include_ps)
+    api_key_hash = hash_api_key(api_key)
+    for s, model in zip(subjects, models):
+        check_prompt_size(s, model, tone, length, include_ps)
     
-    # Generate email
-    result = chain.run(subject=subject)
+    async def gather_emails():
+        return await asyncio.gather(*[
+            agenerate_email(s, get_chain(api_key, api_key_hash, model, max_tokens), tone, length, include_ps)
+            for s, model in zip(subjects, models)
+        ])
     
-    return result.strip()
+    # The batch runs outside the script thread, so session state is only touched once it is done
+    messages = run_async(gather_emails())
+    record_truncation(messages)
+    return [message.content.strip() for message in messages]
+
+# Remember whether the last generation hit the output token limit, so the email is not
+# cached and the user is warned that it may be cut off
+def record_truncation(messages):
+    st.session_state['email_truncated'] = any(is_truncated(message) for message in messages)
+
+# Cache lookup: exact match first, then semantic match for rephrased subjects.
+# Returns the email and, for a semantic hit, the subject it was originally generated for.
+# The caches fail open: any cache error is logged and treated as a miss.
+def lookup_cached_email(subject, params):
+    try:
+        email = get_completion(make_cache_key(subject, *params))
+    except Exception:
+        logger.warning("Exact cache lookup failed", exc_info=True)
+        email = None
+    if email is not None:
+        return email, None
+    semantic_cache = get_semantic_cache()
+    if semantic_cache is not None:
+        try:
+            match = semantic_cache.get(subject, params)
+        except Exception:
+            logger.warning("Semantic cache lookup failed", exc_info=True)
+            match = None
+        if match is not None:
+            matched_subject, email = match
+            return email, matched_subject
+    return None, None
+
+# Store a freshly generated email in both cache tiers; a failed store never discards the email
+def store_cached_email(subject, params, email):
+    try:
+        store_completion(make_cache_key(subject, *params), email)
+    except Exception:
+        logger.warning("Storing in the exact cache failed", exc_info=True)
+    semantic_cache = get_semantic_cache()
+    if semantic_cache is not None:
+        try:
+            semantic_cache.set(subject, email, params)
+        except Exception:
+            logger.warning("Storing in the semantic cache failed", exc_info=True)
 
 # Sidebar for customization options
 with st.sidebar:
@@ -119,12 +280,14 @@ with st.sidebar:
     st.header("Options")
     model_choice = st.selectbox(
         "Select LLM Provider",
-        ["llama3-8b-8192", "llama2-70b-4096"],  # Updated to have different options
-        index=0
+        ["Auto", "llama3-8b-8192", "llama2-70b-4096"],  # Updated to have different options
+        index=0,
+        help="Auto picks a model based on the complexity of the subject"
     )
     
-    # Map selection to model parameters
+    # Map selection to model parameters; a model of None means route per subject
     model_mapping = {
+        "Auto": {"type": "groq", "model": None},
         "llama3-8b-8192": {"type": "groq", "model": "llama3-8b-8192"},
         "llama2-70b-4096": {"type": "groq", "model": "llama2-70b-4096"}
     }
@@ -136,17 +299,42 @@ with st.sidebar:
         email_length = st.slider("Email Length", min_value=1, max_value=5, value=3, 
                               help="Controls the approximate length of the email in paragraphs")
         add_ps = st.checkbox("Add PS line", value=False)
+        num_variants = st.slider("Variants", min_value=1, max_value=4, value=1,
+                                 help="Number of alternative emails to generate concurrently when regenerating")
+
+    if st.button("Clear cache", help="Discard stored emails so the next request calls the LLM again"):
+        try:
+            clear_cache()
+            semantic_cache = get_semantic_cache()
+            if semantic_cache is not None:
+                semantic_cache.clear()
+            st.success("Cache cleared.")
+        except Exception as e:
+            st.error(f"Error clearing cache: {str(e)}")
 
 # Main app interface
 col1, col2 = st.columns([1, 1])
 
+# Copy the selected sample into the subject field; runs as a widget callback
+# before the rerun, so picking a sample costs a single script execution
+def use_sample_subject():
+    if st.session_state.get('sample_subject'):
+        st.session_state['subject_input'] = st.session_state['sample_subject']
+
 with col1:
     st.subheader("Email Input")
-    subject = st.text_input("Enter your email subject:", placeholder="e.g., Exclusive Invitation to Our Premium Webinar")
+    
+    # The form only reruns the script on submit, not on every edit of the subject
+    with st.form("generate_email_form"):
+        subject = st.text_input(
+            "Enter your email subject:",
+            key="subject_input",
+            placeholder="e.g., Exclusive Invitation to Our Premium Webinar"
+        )
+        generate_clicked = st.form_submit_button("Generate Email", type="primary")
     
     # Sample subjects for inspiration
     if st.checkbox("Show sample subjects"):
-        st.caption("Sample subjects (click to use):")
         sample_subjects = [
             "Quarterly Strategy Meeting - June 15th",
             "Introducing Our Revolutionary New Product Line",
@@ -155,22 +343,53 @@ with col1:
             "We Value Your Opinion on Your Recent Purchase"
         ]
         
-        for sample in sample_subjects:
-            if st.button(sample, key=sample):
-                st.session_state['subject'] = sample
-                subject = sample
+        st.radio(
+            "Sample subjects (select to use):",
+            sample_subjects,
+            index=None,
+            key="sample_subject",
+            on_change=use_sample_subject
+        )
+        
+        if st.button("Generate emails for all samples"):
+            with st.spinner("Generating sample emails..."):
+                try:
+                    emails = generate_emails_concurrently(
+                        sample_subjects,
+                        api_key,
+                        model_name=selected_model["model"],
+                        tone=email_tone,
+                        length=email_length,
+                        include_ps=add_ps
+                    )
+                    st.session_state['email_variants'] = list(zip(sample_subjects, emails))
+                    st.session_state.pop('matched_subject', None)
+                    st.session_state['generated_email'] = emails[0]
+                    st.session_state['subject'] = sample_subjects[0]
+                except Exception as e:
+                    st.error(f"Error generating sample emails: {str(e)}")
     
-    if st.button("Generate Email", type="primary"):
+    if generate_clicked:
         if subject:
             with st.spinner("Generating your email..."):
                 try:
-                    email_content = generate_email(
-                        subject, 
-                        api_key, 
-                        model_type=selected_model["type"]
-                    )
+                    st.session_state.pop('email_variants', None)
+                    model_name = selected_model["model"] or route_model(subject)
+                    params = (model_name, email_tone, email_length, add_ps, hash_api_key(api_key))
+                    email_content, matched_subject = lookup_cached_email(subject, params)
+                    st.session_state['matched_subject'] = matched_subject
+                    st.session_state['email_truncated'] = False
+                    if email_content is None:
+                        # Show the email as it is generated instead of waiting for the full completion
+                        with col2:
+                            email_content = st.write_stream(
+                                stream_email(subject, api_key, model_name, email_tone, email_length, add_ps)
+                            ).strip()
+                        if not st.session_state['email_truncated']:
+                            store_cached_email(subject, params, email_content)
                     st.session_state['generated_email'] = email_content
                     st.session_state['subject'] = subject
+                    st.rerun()
                 except Exception as e:
                     st.error(f"Error generating email: {str(e)}")
         else:
@@ -180,10 +399,33 @@ with col2:
     st.subheader("Generated Email")
     if 'generated_email' in st.session_state:
         email_content = st.session_state['generated_email']
-        st.text_area("Email Content", email_content, height=400)
+        variants = st.session_state.get('email_variants', [])
+        if st.session_state.get('email_truncated'):
+            st.warning("The email reached the output token limit and may be cut off. Try regenerating it or lowering the email length.")
+        # A semantic cache hit reuses an email written for a similar subject, so say which one
+        if st.session_state.get('matched_subject'):
+            st.info(
+                f"Reused the email generated for the similar subject \"{st.session_state['matched_subject']}\". "
+                "Click Regenerate for a new email."
+            )
+        if len(variants) > 1:
+            tabs = st.tabs([label for label, _ in variants])
+            for i, (tab, (label, variant)) in enumerate(zip(tabs, variants)):
+                with tab:
+                    st.text_area("Email Content", variant, height=400, key=f"variant_{i}")
+                    if st.button("Use this email", key=f"use_variant_{i}"):
+                        st.session_state['generated_email'] = variant
+                        st.rerun()
+        else:
+            st.text_area("Email Content", email_content, height=400)
+        
+        # Copy via the built-in copy button of st.code, which needs no custom JavaScript
+        with st.expander("Copy to Clipboard"):
+            st.caption("Use the copy icon in the top-right corner of the box below.")
+            st.code(email_content, language=None)
         
         # Action buttons
-        col_a, col_b, col_c = st.columns(3)
+        col_a, col_b = st.columns(2)
         with col_a:
             st.download_button(
                 label="Download Email",
@@ -192,42 +434,29 @@ with col2:
                 mime="text/plain"
             )
         with col_b:
-            if st.button("Copy to Clipboard", help="Copy the email content to your clipboard"):
-                js_code = f"""
-                <script>
-                    try {{
-                        const text = {repr(email_content)};
-                        navigator.clipboard.writeText(text)
-                            .then(() => {{
-                                window.streamlitMessageListener.handleMessage({{
-                                    type: 'streamlit:message',
-                                    data: {{ type: 'success', message: 'Email copied to clipboard!' }}
-                                }});
-                            }})
-                            .catch(err => {{
-                                console.error('Failed to copy: ', err);
-                                window.streamlitMessageListener.handleMessage({{
-                                    type: 'streamlit:message',
-                                    data: {{ type: 'error', message: 'Failed to copy to clipboard. Please try selecting and copying manually.' }}
-                                }});
-                            }});
-                    }} catch (err) {{
-                        console.error('Error: ', err);
-                    }}
-                </script>
-                """
-                st.components.v1.html(js_code, height=0)
-        with col_c:
             if st.button("Regenerate"):
                 if 'subject' in st.session_state:
                     with st.spinner("Regenerating email..."):
                         try:
-                            email_content = generate_email(
-                                st.session_state['subject'], 
+                            # Bypass the cache: regenerating should produce fresh emails.
+                            # Groq only accepts n=1, so variants are separate concurrent requests
+                            # rather than one request with n=num_variants.
+                            emails = generate_emails_concurrently(
+                                [st.session_state['subject']] * num_variants,
                                 api_key,
-                                model_type=selected_model["type"]
+                                model_name=selected_model["model"],
+                                tone=email_tone,
+                                length=email_length,
+                                include_ps=add_ps
                             )
-                            st.session_state['generated_email'] = email_content
+                            if num_variants > 1:
+                                st.session_state['email_variants'] = [
+                                    (f"Variant {i + 1}", email) for i, email in enumerate(emails)
+                                ]
+                            else:
+                                st.session_state.pop('email_variants', None)
+                            st.session_state['generated_email'] = emails[0]
+                            st.session_state.pop('matched_subject', None)
                             st.rerun()
                         except Exception as e:
                             st.error(f"Error regenerating email: {str(e)}")
@@ -273,4 +502,4 @@ with st.sidebar.expander("Enterprise Settings"):
     st.session_state["user_preferences"]["default_signature"] = st.text_area(
         "Default Signature",
         value=st.session_state["user_preferences"]["default_signature"]
-    )
\ No newline at end of file
+    )
@@ -0,0 +1,140 @@
+"""
+Response caching for the Smart Email Generator.
+Identical generation requests are served from a cache instead of a fresh LLM call.
+The cache lives on local disk by default, or in Redis when REDIS_URL is set so that
+every replica of a shared deployment sees the same entries.
+"""
+
+import hashlib
+import os
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Optional
+
+from diskcache import Cache
+
+try:
+    import redis
+except ImportError:  # Redis is only needed for shared deployments
+    redis = None
+
+# Directory used to persist cached emails across app restarts
+CACHE_DIR = ".email_cache"
+
+# Lifetime of Redis entries unless overridden by EMAIL_CACHE_TTL
+DEFAULT_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Prefix of the Redis hashes holding exact-match entries
+REDIS_KEY_PREFIX = "email:"
+
+
+class CacheBackend(ABC):
+    """Interface for stores that map a cache key to a generated email"""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: str) -> None:
+        ...
+
+    @abstractmethod
+    def clear(self) -> None:
+        ...
+
+
+class DiskCacheBackend(CacheBackend):
+    """Stores emails in a local diskcache directory"""
+
+    def __init__(self, directory: str = CACHE_DIR):
+        self._cache = Cache(directory)
+
+    def get(self, key: str) -> Optional[str]:
+        return self._cache.get(key)
+
+    def set(self, key: str, value: str) -> None:
+        self._cache.set(key, value)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+
+class RedisBackend(CacheBackend):
+    """Stores emails as Redis hashes that expire after a TTL"""
+
+    def __init__(self, client, ttl: Optional[int] = None):
+        self._client = client
+        self._ttl = ttl or get_cache_ttl()
+
+    def get(self, key: str) -> Optional[str]:
+        value = self._client.hget(REDIS_KEY_PREFIX + key, "response")
+        return value.decode() if value is not None else None
+
+    def set(self, key: str, value: str) -> None:
+        name = REDIS_KEY_PREFIX + key
+        pipeline = self._client.pipeline()
+        pipeline.hset(name, "response", value)
+        pipeline.expire(name, self._ttl)
+        pipeline.execute()
+
+    def clear(self) -> None:
+        for name in self._client.scan_iter(match=REDIS_KEY_PREFIX + "*"):
+            self._client.delete(name)
+
+
+_backend: Optional[CacheBackend] = None
+_redis_client = None
+_lock = threading.Lock()
+
+
+def hash_api_key(api_key: str) -> str:
+    """Returns a digest of the API key so the raw secret is never used as a cache key"""
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+def make_cache_key(*parts: Any) -> str:
+    """Builds a cache key from the parameters that determine a generated email"""
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def get_cache_ttl() -> int:
+    """Returns the lifetime in seconds of shared cache entries"""
+    return int(os.getenv("EMAIL_CACHE_TTL", DEFAULT_CACHE_TTL_SECONDS))
+
+
+def get_redis_client():
+    """Returns the shared Redis client, or None when REDIS_URL is unset or redis is not installed"""
+    global _redis_client
+    redis_url = os.getenv("REDIS_URL")
+    if not redis_url or redis is None:
+        return None
+    with _lock:
+        if _redis_client is None:
+            _redis_client = redis.Redis.from_url(redis_url)
+        return _redis_client
+
+
+def get_backend() -> CacheBackend:
+    """Returns the shared cache backend, choosing Redis when it is configured"""
+    global _backend
+    client = get_redis_client()
+    with _lock:
+        if _backend is None:
+            _backend = RedisBackend(client) if client is not None else DiskCacheBackend()
+        return _backend
+
+
+def get_completion(key: str) -> Optional[str]:
+    """Returns the stored completion for key, or None on a miss"""
+    return get_backend().get(key)
+
+
+def store_completion(key: str, completion: str) -> None:
+    """Stores a completion under key"""
+    get_backend().set(key, completion)
+
+
+def clear_cache() -> None:
+    """Removes every stored completion"""
+    get_backend().clear()
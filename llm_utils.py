@@ -0,0 +1,62 @@
+"""
+Helpers shared by app.py and advanced_features.py for LLM requests and responses:
+async execution, prompt caching and response metadata.
+Kept apart from advanced_features.py so that app.py can use them without importing its chains.
+"""
+
+import asyncio
+import threading
+from typing import Any, Awaitable, Dict, List, TypeVar
+
+from langchain_core.messages import BaseMessage, SystemMessage
+
+T = TypeVar("T")
+
+# Event loop shared by every async LLM call. Cached clients keep their HTTP connections bound to
+# the loop they were first used on, so each batch runs on this long-lived loop, not asyncio.run.
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+
+def run_async(coro: Awaitable[T]) -> T:
+    """Runs a coroutine on the shared background event loop and waits for its result"""
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            _event_loop = asyncio.new_event_loop()
+            threading.Thread(target=_event_loop.run_forever, daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, _event_loop).result()
+
+
+def is_truncated(message: Any) -> bool:
+    """Returns whether a chat model response or completion generation was cut off by its output token limit"""
+    metadata = getattr(message, "response_metadata", None) or getattr(message, "generation_info", None) or {}
+    return metadata.get("finish_reason") == "length" or metadata.get("stop_reason") == "max_tokens"
+
+
+def add_cache_control(messages: List[BaseMessage]) -> List[BaseMessage]:
+    """Marks system messages with Anthropic's ephemeral cache_control so the static prefix is cached"""
+    cached = []
+    for message in messages:
+        if isinstance(message, SystemMessage) and isinstance(message.content, str):
+            message = SystemMessage(content=[{
+                "type": "text",
+                "text": message.content,
+                "cache_control": {"type": "ephemeral"}
+            }])
+        cached.append(message)
+    return cached
+
+
+def extract_cache_usage(message: Any) -> Dict[str, int]:
+    """Reads prompt cache token counts from a chat model response or its metadata dict.
+    Anthropic reports cache writes and reads; OpenAI-compatible providers report cached prompt tokens."""
+    metadata = message if isinstance(message, dict) else getattr(message, "response_metadata", None) or {}
+    usage = metadata.get("usage") or metadata.get("token_usage") or {}
+    if not isinstance(usage, dict):
+        usage = dict(usage)
+    prompt_details = usage.get("prompt_tokens_details") or {}
+    return {
+        "cache_creation_input_tokens": usage.get("cache_creation_input_tokens") or 0,
+        "cache_read_input_tokens": usage.get("cache_read_input_tokens") or prompt_details.get("cached_tokens") or 0
+    }
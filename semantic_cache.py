@@ -0,0 +1,450 @@
+"""
+Semantic cache for the Smart Email Generator.
+Subjects are embedded with a small local model so that rephrased subjects can reuse
+a previously generated email instead of triggering a new LLM call.
+Entries are kept in a local FAISS index, or in a Redis vector index when REDIS_URL is set.
+"""
+
+import importlib.util
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import streamlit as st
+
+from email_cache import get_cache_ttl, get_redis_client, make_cache_key
+
+# Semantic caching is optional; without these packages the app falls back to exact-match caching.
+# They are slow to import (sentence-transformers pulls in torch), so each is only imported on first use.
+SENTENCE_TRANSFORMERS_AVAILABLE = importlib.util.find_spec("sentence_transformers") is not None
+FAISS_AVAILABLE = importlib.util.find_spec("faiss") is not None
+# Only checks for redis-py; whether the server has the Search module is found out when the index is created
+REDIS_AVAILABLE = importlib.util.find_spec("redis") is not None
+
+# Without numba the similarity scan falls back to a numpy matrix-vector product
+NUMBA_AVAILABLE = importlib.util.find_spec("numba") is not None
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+EMBEDDING_DIM = 384
+
+# Minimum cosine similarity for two subjects to be treated as the same request
+SIMILARITY_THRESHOLD = 0.92
+
+# Number of nearest neighbours checked for an entry with matching parameters
+SEARCH_DEPTH = 5
+
+# Below this many entries a direct similarity scan over a float32 matrix is faster than a
+# FAISS search. Each embedding is held once in memory: new entries stay in the matrix until
+# there are this many, then move into the quantized FAISS index in one batch.
+KERNEL_MAX_ENTRIES = 5000
+
+# The embedding matrix grows by this many rows at a time to avoid copying on every insert
+MATRIX_CHUNK_ROWS = 1024
+
+# Precision of the embeddings stored in the FAISS index: "fp32", "fp16" or "int8".
+# fp16 halves memory with negligible effect on cosine scores; int8 quarters it but may
+# need a lower SIMILARITY_THRESHOLD.
+DEFAULT_QUANTIZATION = "fp16"
+
+CACHE_DIR = ".semantic_cache"
+INDEX_FILE = "index.faiss"
+METADATA_FILE = "entries.sqlite3"
+
+# Redis Search index and key prefix for shared deployments
+REDIS_INDEX_NAME = "emails"
+REDIS_KEY_PREFIX = "semantic:"
+
+# Seconds to wait before setting up a semantic cache store again after it failed
+SETUP_RETRY_SECONDS = 60
+
+logger = logging.getLogger(__name__)
+
+
+def _numpy_similarity_scores(query: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+    return matrix @ query
+
+
+@lru_cache(maxsize=None)
+def _load_similarity_kernel() -> Callable[[np.ndarray, np.ndarray], np.ndarray]:
+    if not NUMBA_AVAILABLE:
+        return _numpy_similarity_scores
+    from similarity_kernel import similarity_scores
+    return similarity_scores
+
+
+def cosine_topk(query: np.ndarray, matrix: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the indices and scores of the k rows of matrix most similar to query, best first.
+    Rows and query must be normalized so that the dot product equals cosine similarity."""
+    scores = _load_similarity_kernel()(query, matrix)
+    k = min(k, len(scores))
+    ids = np.argpartition(-scores, k - 1)[:k]
+    ids = ids[np.argsort(-scores[ids])]
+    return ids, scores[ids]
+
+
+@st.cache_resource(show_spinner=False)
+def warm_similarity_kernel() -> None:
+    """Compiles the similarity kernel once per process so the first lookup does not pay for JIT"""
+    cosine_topk(np.zeros(EMBEDDING_DIM, dtype=np.float32), np.zeros((1, EMBEDDING_DIM), dtype=np.float32), 1)
+
+
+def numbers_match(subject: str, other: str) -> bool:
+    """Returns whether two subjects contain the same numbers, such as dates, prices or quantities.
+    Embeddings barely distinguish "June 15th" from "June 16th", so such subjects never share an email."""
+    return re.findall(r"\d+", subject) == re.findall(r"\d+", other)
+
+
+def create_index(quantization: str = DEFAULT_QUANTIZATION):
+    """Creates an empty inner-product FAISS index that stores embeddings at the given precision"""
+    import faiss
+    if quantization == "fp32":
+        return faiss.IndexFlatIP(EMBEDDING_DIM)
+    quantizer_types = {
+        "fp16": faiss.ScalarQuantizer.QT_fp16,
+        "int8": faiss.ScalarQuantizer.QT_8bit
+    }
+    if quantization not in quantizer_types:
+        raise ValueError(f"Unsupported quantization: {quantization}")
+    index = faiss.IndexScalarQuantizer(EMBEDDING_DIM, quantizer_types[quantization], faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        # Normalized embeddings lie in [-1, 1], so the quantizer ranges can be trained on those bounds
+        bounds = np.vstack([-np.ones(EMBEDDING_DIM), np.ones(EMBEDDING_DIM)]).astype(np.float32)
+        index.train(bounds)
+    return index
+
+
+@st.cache_resource(show_spinner=False)
+def load_embedding_model():
+    """Loads the sentence embedding model once per process"""
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(EMBEDDING_MODEL)
+
+
+class BaseSemanticCache(ABC):
+    """Embeds subjects and defines the lookup interface shared by the semantic cache stores"""
+
+    def __init__(self, model, threshold: float = SIMILARITY_THRESHOLD):
+        self.model = model
+        self.threshold = threshold
+        # A lookup miss is usually followed by storing the same subject, so keep its embedding
+        self._last_embedding: Optional[Tuple[str, np.ndarray]] = None
+
+    def embed(self, subject: str) -> np.ndarray:
+        """Returns the normalized embedding of a subject so inner product equals cosine similarity"""
+        last = self._last_embedding
+        if last is not None and last[0] == subject:
+            return last[1]
+        embedding = self.model.encode([subject], convert_to_numpy=True, normalize_embeddings=True)
+        embedding = np.ascontiguousarray(embedding, dtype=np.float32)
+        self._last_embedding = (subject, embedding)
+        return embedding
+
+    @abstractmethod
+    def get(self, subject: str, params: Any,
+            embedding: Optional[np.ndarray] = None) -> Optional[Tuple[str, str]]:
+        """Returns the most similar cached subject generated with the same params and its email"""
+
+    @abstractmethod
+    def set(self, subject: str, email: str, params: Any, embedding: Optional[np.ndarray] = None) -> None:
+        """Stores a generated email"""
+
+    @abstractmethod
+    def clear(self) -> None:
+        """Removes every cached entry"""
+
+
+class SemanticCache(BaseSemanticCache):
+    """Maps subject embeddings to generated emails using a local FAISS inner-product index.
+
+    Entries, embeddings included, are stored in SQLite under ids that SQLite assigns, so several
+    processes can share the cache directory; before each operation a process reads the entries
+    the others have added since. New entries are searched with a direct scan over an embedding
+    matrix and folded into the quantized FAISS index once there are KERNEL_MAX_ENTRIES of them.
+    Only then is the index written to disk, and it is memory-mapped rather than rebuilt on startup."""
+
+    def __init__(self, model, cache_dir: str = CACHE_DIR, threshold: float = SIMILARITY_THRESHOLD,
+                 quantization: str = DEFAULT_QUANTIZATION):
+        super().__init__(model, threshold)
+        self.cache_dir = cache_dir
+        self.quantization = quantization
+        self._lock = threading.Lock()
+        self._index = self._create_index()
+        self._index_mapped = False
+        # Over-allocated matrix of the entries not yet in the index; only the first _pending rows are valid
+        self._matrix = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        self._matrix_ids = np.empty(0, dtype=np.int64)
+        self._pending = 0
+        # Highest entry id read from SQLite; ids only grow, so newer entries are found by id
+        self._last_id = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._db = self._connect()
+        self._load()
+
+    def get(self, subject: str, params: Any,
+            embedding: Optional[np.ndarray] = None) -> Optional[Tuple[str, str]]:
+        """Returns the most similar cached subject generated with the same params and its email"""
+        if embedding is None:
+            embedding = self.embed(subject)
+        params_key = make_cache_key(params)
+        with self._lock:
+            self._sync()
+            for score, entry_id in self._search(embedding):
+                if score < self.threshold:
+                    break
+                row = self._db.execute(
+                    "SELECT subject, email, embedding FROM entries WHERE id = ? AND params_key = ?",
+                    (entry_id, params_key)
+                ).fetchone()
+                if row is None or not numbers_match(subject, row[0]):
+                    continue
+                # Check the stored embedding too, so an id that no longer matches its entry is never served
+                if float(np.frombuffer(row[2], dtype=np.float32) @ embedding[0]) >= self.threshold:
+                    return row[0], row[1]
+        return None
+
+    def set(self, subject: str, email: str, params: Any, embedding: Optional[np.ndarray] = None) -> None:
+        """Stores a generated email"""
+        if embedding is None:
+            embedding = self.embed(subject)
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "INSERT INTO entries (subject, email, params_key, embedding) VALUES (?, ?, ?, ?)",
+                    (subject, email, make_cache_key(params), embedding.tobytes())
+                )
+            self._sync()
+
+    def clear(self) -> None:
+        """Removes every cached entry, in memory and on disk"""
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM entries")
+            self._index = self._create_index()
+            self._index_mapped = False
+            self._pending = 0
+            if os.path.exists(self._index_path()):
+                os.remove(self._index_path())
+
+    def _search(self, embedding: np.ndarray) -> List[Tuple[float, int]]:
+        candidates = []
+        if self._pending:
+            rows, scores = cosine_topk(embedding[0], self._matrix[:self._pending], SEARCH_DEPTH)
+            candidates.extend(zip(scores.tolist(), self._matrix_ids[rows].tolist()))
+        if self._index.ntotal:
+            scores, ids = self._index.search(embedding, min(SEARCH_DEPTH, self._index.ntotal))
+            candidates.extend(zip(scores[0].tolist(), ids[0].tolist()))
+        return sorted(candidates, reverse=True)
+
+    def _sync(self) -> None:
+        # Read the entries added since the last sync, by this process or any other
+        rows = self._db.execute(
+            "SELECT id, embedding FROM entries WHERE id > ? ORDER BY id", (self._last_id,)
+        ).fetchall()
+        if not rows:
+            return
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        embeddings = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+        self._append(ids, embeddings)
+        self._last_id = int(ids[-1])
+
+    def _append(self, ids: np.ndarray, embeddings: np.ndarray) -> None:
+        pending = self._pending + len(ids)
+        if pending > len(self._matrix):
+            rows = pending + MATRIX_CHUNK_ROWS
+            matrix = np.empty((rows, EMBEDDING_DIM), dtype=np.float32)
+            matrix_ids = np.empty(rows, dtype=np.int64)
+            matrix[:self._pending] = self._matrix[:self._pending]
+            matrix_ids[:self._pending] = self._matrix_ids[:self._pending]
+            self._matrix, self._matrix_ids = matrix, matrix_ids
+        self._matrix[self._pending:pending] = embeddings
+        self._matrix_ids[self._pending:pending] = ids
+        self._pending = pending
+        if pending >= KERNEL_MAX_ENTRIES:
+            self._fold()
+
+    def _fold(self) -> None:
+        # Move the scanned entries into the quantized index and release their full-precision copy
+        import faiss
+        if self._index_mapped:
+            # Copy the mapped index rather than re-reading the file, which another process may have replaced
+            self._index = faiss.clone_index(self._index)
+            self._index_mapped = False
+        self._index.add_with_ids(self._matrix[:self._pending], self._matrix_ids[:self._pending])
+        self._matrix = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        self._matrix_ids = np.empty(0, dtype=np.int64)
+        self._pending = 0
+        # Write to a temporary file and rename, so a process mapping the old index never sees a partial
+        # write; the name is per process because several processes may fold at the same time
+        index_path = self._index_path()
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        faiss.write_index(self._index, tmp_path)
+        os.replace(tmp_path, index_path)
+
+    def _create_index(self):
+        import faiss
+        return faiss.IndexIDMap(create_index(self.quantization))
+
+    def _index_path(self) -> str:
+        return os.path.join(self.cache_dir, INDEX_FILE)
+
+    def _connect(self) -> sqlite3.Connection:
+        # WAL mode lets other processes read entries while one writes.
+        # AUTOINCREMENT keeps ids unique across processes and never reuses them, even after a clear.
+        db = sqlite3.connect(os.path.join(self.cache_dir, METADATA_FILE), check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        columns = {row[1] for row in db.execute("PRAGMA table_info(entries)")}
+        if columns and "embedding" not in columns:
+            # Entries written before embeddings were stored alongside them cannot be searched
+            db.execute("DROP TABLE entries")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, subject TEXT NOT NULL, email TEXT NOT NULL, "
+            "params_key TEXT NOT NULL, embedding BLOB NOT NULL)"
+        )
+        db.commit()
+        return db
+
+    def _load(self) -> None:
+        import faiss
+        index_path = self._index_path()
+        if os.path.exists(index_path):
+            index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            ids = faiss.vector_to_array(index.id_map)
+            last_id = int(ids.max()) if len(ids) else 0
+            (stored,) = self._db.execute("SELECT COUNT(*) FROM entries WHERE id <= ?", (last_id,)).fetchone()
+            # An index left over from before a clear is ignored and the entries are read from SQLite instead
+            if stored == index.ntotal:
+                self._index = index
+                self._index_mapped = True
+                self._last_id = last_id
+        self._sync()
+
+
+class RedisSemanticCache(BaseSemanticCache):
+    """Shares semantic cache entries across replicas through a Redis Search HNSW vector index"""
+
+    def __init__(self, model, client, threshold: float = SIMILARITY_THRESHOLD, ttl: Optional[int] = None):
+        super().__init__(model, threshold)
+        self._client = client
+        self._ttl = ttl or get_cache_ttl()
+        self._ensure_index()
+
+    def get(self, subject: str, params: Any,
+            embedding: Optional[np.ndarray] = None) -> Optional[Tuple[str, str]]:
+        from redis.commands.search.query import Query
+        if embedding is None:
+            embedding = self.embed(subject)
+        query = (
+            Query(f"(@params:{{{self._params_tag(params)}}})=>[KNN {SEARCH_DEPTH} @emb $vec AS distance]")
+            .sort_by("distance")
+            .return_fields("subject", "email", "distance")
+            .dialect(2)
+        )
+        result = self._client.ft(REDIS_INDEX_NAME).search(query, query_params={"vec": embedding.tobytes()})
+        for doc in result.docs:
+            # Redis reports cosine distance; convert it back to similarity
+            if 1 - float(doc.distance) < self.threshold:
+                break
+            if numbers_match(subject, doc.subject):
+                return doc.subject, doc.email
+        return None
+
+    def set(self, subject: str, email: str, params: Any, embedding: Optional[np.ndarray] = None) -> None:
+        if embedding is None:
+            embedding = self.embed(subject)
+        name = REDIS_KEY_PREFIX + make_cache_key(subject, params)
+        pipeline = self._client.pipeline()
+        pipeline.hset(name, mapping={
+            "subject": subject,
+            "email": email,
+            "params": self._params_tag(params),
+            "emb": embedding.tobytes()
+        })
+        pipeline.expire(name, self._ttl)
+        pipeline.execute()
+
+    def clear(self) -> None:
+        for name in self._client.scan_iter(match=REDIS_KEY_PREFIX + "*"):
+            self._client.delete(name)
+
+    @staticmethod
+    def _params_tag(params: Any) -> str:
+        # Hex digests are safe to use as Redis Search tag values
+        return make_cache_key(params)
+
+    def _ensure_index(self) -> None:
+        from redis.commands.search.field import TagField, TextField, VectorField
+        from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+        from redis.exceptions import ResponseError
+        search = self._client.ft(REDIS_INDEX_NAME)
+        try:
+            search.info()
+        except ResponseError:
+            search.create_index(
+                [
+                    TextField("subject"),
+                    TagField("params"),
+                    VectorField("emb", "HNSW", {
+                        "TYPE": "FLOAT32",
+                        "DIM": EMBEDDING_DIM,
+                        "DISTANCE_METRIC": "COSINE"
+                    })
+                ],
+                definition=IndexDefinition(prefix=[REDIS_KEY_PREFIX], index_type=IndexType.HASH)
+            )
+
+
+@st.cache_resource(show_spinner=False)
+def get_redis_semantic_cache() -> RedisSemanticCache:
+    """Returns the process-wide Redis semantic cache; errors are raised so that Streamlit does not cache them"""
+    return RedisSemanticCache(load_embedding_model(), get_redis_client())
+
+
+@st.cache_resource(show_spinner=False)
+def get_local_semantic_cache() -> SemanticCache:
+    """Returns the process-wide local FAISS semantic cache; errors are raised so that Streamlit does not cache them"""
+    warm_similarity_kernel()
+    return SemanticCache(
+        load_embedding_model(),
+        quantization=os.getenv("SEMANTIC_CACHE_QUANTIZATION", DEFAULT_QUANTIZATION)
+    )
+
+
+_setup_failures: Dict[str, float] = {}
+
+
+def get_semantic_cache() -> Optional[BaseSemanticCache]:
+    """Returns the semantic cache, or None when it is unavailable.
+    Redis is used when configured so that all replicas share entries, falling back to a local FAISS
+    index when Redis cannot be used. A store that fails to set up is retried after SETUP_RETRY_SECONDS."""
+    if not SENTENCE_TRANSFORMERS_AVAILABLE:
+        return None
+    if REDIS_AVAILABLE and get_redis_client() is not None:
+        cache = _set_up("Redis", get_redis_semantic_cache)
+        if cache is not None:
+            return cache
+    if FAISS_AVAILABLE:
+        return _set_up("local", get_local_semantic_cache)
+    return None
+
+
+def _set_up(name: str, setup: Callable[[], BaseSemanticCache]) -> Optional[BaseSemanticCache]:
+    # Setup errors are logged and disable semantic caching, not generation, until the retry delay passes
+    failed_at = _setup_failures.get(name)
+    if failed_at is not None and time.monotonic() - failed_at < SETUP_RETRY_SECONDS:
+        return None
+    try:
+        cache = setup()
+    except Exception:
+        logger.warning("%s semantic cache unavailable", name, exc_info=True)
+        _setup_failures[name] = time.monotonic()
+        return None
+    _setup_failures.pop(name, None)
+    return cache
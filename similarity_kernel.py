@@ -0,0 +1,20 @@
+"""
+Numba-compiled similarity scan for the semantic cache.
+Kept in its own module so that numba is only imported once a lookup needs the kernel.
+"""
+
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def similarity_scores(query: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+    """Returns the dot product of query with every row of matrix"""
+    rows, dim = matrix.shape
+    scores = np.empty(rows, dtype=np.float32)
+    for i in prange(rows):
+        total = np.float32(0.0)
+        for j in range(dim):
+            total += matrix[i, j] * query[j]
+        scores[i] = total
+    return scores